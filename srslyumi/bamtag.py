@@ -4,11 +4,13 @@ Move bcl2fastq read name UMIs to a BAM tag
 import argparse
 import re
 import sys
+import zlib
 
 import pysam
 
 
 UMI_REGULAR_EXPRESSION = "^[acgtnAGCTN_+-]+$"
+HASH_SPACE = 2 ** 32
 
 
 def looks_like_umi(umi):
@@ -64,27 +66,117 @@ def take_fragment(umi, fragment_index):
     return frags[fragment_index]
 
 
-def bamtag(inbam, out, sam_tag, keep_symbols, fragment_index, quiet):
+def primary_start(read):
+    """
+    Returns the (reference_name, position) of the read's primary
+    alignment, or None if the read is unplaced. Secondary and
+    supplementary records take it from the first entry of their SA tag;
+    without one (bwa puts secondary hits in XA instead) they fall back
+    to their own position.
+    """
+    if (read.is_secondary or read.is_supplementary) and read.has_tag("SA"):
+        rname, pos = read.get_tag("SA").split(",")[:2]
+        return rname, int(pos) - 1
+    if read.reference_id < 0 or read.reference_start < 0:
+        return None
+    return read.reference_name, read.reference_start
+
+
+def molecule_start(read):
+    """
+    Returns a (reference_name, position) shared by every record of the
+    read's template: the smaller of the placed primary starts of the
+    read and its mate, comparing reference names as text. Unmapped
+    reads take their mate's position. Secondary and supplementary
+    records without an SA tag use their own position in place of the
+    primary's, and so may be split from their template.
+    """
+    starts = []
+    start = primary_start(read)
+    if start is not None:
+        starts.append(start)
+    mate_placed = read.next_reference_id >= 0 and read.next_reference_start >= 0
+    if read.is_paired and mate_placed:
+        starts.append((read.next_reference_name, read.next_reference_start))
+    if not starts:
+        return "*", -1
+    return min(starts)
+
+
+def umi_hash(umi, reference_name, position):
+    """
+    Deterministic 32-bit hash of a UMI and alignment start, used to
+    keep or drop whole molecules when subsampling
+
+    >>> umi_hash("ACGT", "chr1", 14375)
+    926405969
+    >>> umi_hash("ACGT", "chr1", 14376)
+    2923332843
+    """
+    key = "{}:{}:{}".format(umi, reference_name, position)
+    return zlib.crc32(key.encode("ascii")) & 0xFFFFFFFF
+
+
+def subsample_fraction(value):
+    """
+    argparse type for a subsampling fraction in (0, 1]
+
+    >>> subsample_fraction("0.25")
+    0.25
+    """
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        msg = "subsample fraction must be in (0, 1]: {!r}".format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return fraction
+
+
+def bamtag(
+    inbam,
+    out,
+    sam_tag,
+    keep_symbols,
+    fragment_index,
+    quiet,
+    subsample=None,
+    subsample_out=None,
+):
+    if (subsample is None) != (subsample_out is None):
+        raise ValueError("subsample and subsample_out must be given together")
     num_missing_umis = 0
     reads = 0
+    if subsample_out is not None:
+        threshold = int(subsample * HASH_SPACE)
     for read in inbam.fetch(until_eof=True):
         reads += 1
         name, _, umi = read.query_name.rpartition(":")
         if looks_like_umi(umi):
+            if subsample_out is not None or not keep_symbols:
+                friendly = picard_friendly(umi)
             if not keep_symbols:
-                umi = picard_friendly(umi)
+                umi = friendly
             if fragment_index is not None:
                 umi = take_fragment(umi, fragment_index)
             read.query_name = name
             read.set_tag(sam_tag, umi, "Z")
         else:
             num_missing_umis += 1
+            friendly = ""
         out.write(read)
+        if subsample_out is not None:
+            if umi_hash(friendly, *molecule_start(read)) < threshold:
+                subsample_out.write(read)
     if not quiet and num_missing_umis > 0:
         msg = "WARNING: {} of {} reads did not have a UMI_like string\n"
         sys.stderr.write(msg.format(num_missing_umis, reads))
 
 
+def output_mode(fn, binary):
+    if (isinstance(fn, str) and fn.endswith("bam")) or binary:
+        return "wb"
+    return "w"
+
+
 def main():
     ap = argparse.ArgumentParser(__doc__)
     ap.add_argument(
@@ -105,20 +197,47 @@ def main():
     )
     ap.add_argument("-q", "--quiet", action="store_true", help="don't report warnings")
     ap.add_argument("-o", default=sys.stdout, help="output SAM/BAM (default: STDOUT)")
+    ap.add_argument(
+        "--subsample",
+        type=subsample_fraction,
+        metavar="FRACTION",
+        help=(
+            "keep this fraction of molecules in --subsample-out, chosen by a hash "
+            "of the full picard-friendly UMI and a start shared by the template's "
+            "records (the lower mate start, comparing reference names as text)"
+        ),
+    )
+    ap.add_argument(
+        "--subsample-out", metavar="PATH", help="output SAM/BAM for the subsample"
+    )
     ap.add_argument(
         "inputbam", default=sys.stdin, help="input SAM/BAM (default: STDIN)"
     )
     a = ap.parse_args()
 
-    if (isinstance(a.o, str) and a.o.endswith("bam")) or a.binary:
-        mode = "wb"
-    else:
-        mode = "w"
+    if (a.subsample is None) != (a.subsample_out is None):
+        ap.error("--subsample and --subsample-out must be used together")
 
     inbam = pysam.AlignmentFile(a.inputbam)
-    out = pysam.AlignmentFile(a.o, mode=mode, template=inbam)
-
-    bamtag(inbam, out, a.sam_tag, a.keep_symbols, a.take_fragment, a.quiet)
+    out = pysam.AlignmentFile(a.o, mode=output_mode(a.o, a.binary), template=inbam)
+    if a.subsample_out is not None:
+        mode = output_mode(a.subsample_out, a.binary)
+        subsample_out = pysam.AlignmentFile(a.subsample_out, mode=mode, template=inbam)
+    else:
+        subsample_out = None
+
+    bamtag(
+        inbam,
+        out,
+        a.sam_tag,
+        a.keep_symbols,
+        a.take_fragment,
+        a.quiet,
+        a.subsample,
+        subsample_out,
+    )
 
+    if subsample_out is not None:
+        subsample_out.close()
     out.close()
     inbam.close()
@@ -1,11 +1,53 @@
+from collections import defaultdict
 import filecmp
 import unittest
 import tempfile
 
+import pysam
+
 from srslyumi.tests.test_cli import capture_cli
 from srslyumi.tests.test_cli import f
 
+from srslyumi.bamtag import bamtag
 from srslyumi.bamtag import main
+from srslyumi.bamtag import molecule_start
+from srslyumi.bamtag import umi_hash
+
+
+def unkeyed(read):
+    """Secondary and supplementary records without an SA tag cannot be
+    tied to their primary, so they are exempt from the template checks
+    """
+    return (read.is_secondary or read.is_supplementary) and not read.has_tag("SA")
+
+
+def run_subsample(fraction, *args):
+    """Runs bamtag on the paired-end fixture and returns the records of
+    the full output and of the subsample as (RX, query_name, flag, unkeyed)
+    tuples
+    """
+    with tempfile.NamedTemporaryFile(mode="w+") as out:
+        with tempfile.NamedTemporaryFile(mode="w+") as sub:
+            argv = ["bamtag", "-o", out.name, "--subsample", str(fraction)]
+            argv += ["--subsample-out", sub.name] + list(args)
+            argv += [f("bamtag-in-04.sam")]
+            with capture_cli(argv) as (stdout, stderr):
+                main()
+            result = []
+            for fn in (out.name, sub.name):
+                with pysam.AlignmentFile(fn) as sam:
+                    result.append(
+                        [
+                            (
+                                r.get_tag("RX") if r.has_tag("RX") else "",
+                                r.query_name,
+                                r.flag,
+                                unkeyed(r),
+                            )
+                            for r in sam.fetch(until_eof=True)
+                        ]
+                    )
+            return result
 
 
 class TestBamTag(unittest.TestCase):
@@ -68,3 +110,93 @@ class TestBamTag(unittest.TestCase):
             self.assertTrue(
                 filecmp.cmp(out.name, f("bamtag-out-01.bam")), "BAM output differs"
             )
+
+    def test_subsample_all(self):
+        with tempfile.NamedTemporaryFile(mode="w+") as out:
+            with tempfile.NamedTemporaryFile(mode="w+") as sub:
+                argv = [
+                    "bamtag",
+                    "-o",
+                    out.name,
+                    "--subsample",
+                    "1",
+                    "--subsample-out",
+                    sub.name,
+                    f("bamtag-in-03.sam"),
+                ]
+                with capture_cli(argv) as (stdout, stderr):
+                    main()
+                out.seek(0)
+                sub.seek(0)
+                self.assertListEqual(sub.readlines(), out.readlines())
+
+    def test_subsample_bad_args(self):
+        for args in (
+            ["--subsample", "0.5"],
+            ["--subsample-out", "sub.sam"],
+            ["--subsample", "1.5", "--subsample-out", "sub.sam"],
+        ):
+            argv = ["bamtag"] + args + [f("bamtag-in-01.sam")]
+            with capture_cli(argv) as (stdout, stderr):
+                with self.assertRaises(SystemExit):
+                    main()
+
+    def test_molecule_start(self):
+        starts = defaultdict(set)
+        with pysam.AlignmentFile(f("bamtag-in-04.sam")) as sam:
+            for read in sam.fetch(until_eof=True):
+                key = (read.query_name, read.flag)
+                if unkeyed(read):
+                    starts[key].add(molecule_start(read))
+                else:
+                    starts[read.query_name].add(molecule_start(read))
+        for name, keys in starts.items():
+            self.assertEqual(len(keys), 1, name)
+        prefix = "M02607:163:000000000-G5MCP:1:1101:"
+        # supplementary on chr5 follows its primary through the SA tag
+        self.assertEqual(starts[prefix + "1001:2001:AAAACCCCG+AAAAC"], {("chr1", 1000)})
+        # unmapped mates, placed or not, take the mapped mate's position
+        self.assertEqual(starts[prefix + "1016:2016:CACACACAC+CACAC"], {("chr1", 7000)})
+        self.assertEqual(starts[prefix + "1017:2017:AGAGAGAGA+AGAGA"], {("chr1", 8000)})
+        self.assertEqual(starts[prefix + "1018:2018:TCTCTCTCT+TCTCT"], {("*", -1)})
+        # without SA, a secondary is keyed from its own position
+        name = prefix + "1019:2019:GAGAGAGAG+GAGAG"
+        self.assertEqual(starts[name], {("chr1", 4000)})
+        self.assertEqual(starts[(name, 355)], {("chr1", 4200)})
+
+    def test_subsample_whole_molecules(self):
+        for i in range(1, 21):
+            full, sub = run_subsample(i / 20.0)
+            self.assertListEqual(sub, [r for r in full if r in set(sub)])
+            kept = defaultdict(set)
+            for record in full:
+                umi, name, _, skip = record
+                if skip:
+                    continue
+                kept[name].add(record in sub)
+                if umi:
+                    kept[umi].add(record in sub)
+            for group, decisions in kept.items():
+                self.assertEqual(len(decisions), 1, (i, group))
+
+    def test_subsample_unkeyed_secondary(self):
+        threshold = int(0.5 * 2 ** 32)
+        full, sub = run_subsample("0.5")
+        self.assertEqual(len(full), 50)
+        secondary = [r for r in full if r[2] == 355]
+        self.assertEqual(len(secondary), 1)
+        expected = umi_hash("GAGAGAGAG-GAGAG", "chr1", 4200) < threshold
+        self.assertEqual(secondary[0] in sub, expected)
+
+    def test_subsample_ignores_umi_display(self):
+        _, sub = run_subsample("0.5")
+        expected = [r[1:] for r in sub]
+        for args in (["--keep-symbols"], ["--take-fragment", "1"]):
+            _, sub = run_subsample("0.5", *args)
+            self.assertListEqual([r[1:] for r in sub], expected)
+
+    def test_bamtag_subsample_args(self):
+        with self.assertRaises(ValueError):
+            bamtag(None, None, "RX", False, None, True, subsample=0.5)
+        with self.assertRaises(ValueError):
+            bamtag(None, None, "RX", False, None, True, subsample_out=object())